@@ -1,31 +1,103 @@
 import argparse
 import logging
 import csv
+import gzip
+import io
 import json
+import math
+import re
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from tb_rest_client.rest_client_ce import RestClientCE
 from tb_rest_client.rest import ApiException
 from tb_rest_client.rest_client_base import EntityId
-from tenacity import retry, stop_after_attempt, wait_fixed
+from tenacity import before_sleep_log, retry, retry_if_exception, stop_after_attempt, wait_exponential, wait_random
+from urllib3.exceptions import HTTPError
+
+try:
+    from orjson import JSONEncodeError, dumps as _orjson_dumps, loads as _orjson_loads
+
+    _LONG_DIGITS = re.compile(r'\d{19}')
+
+    def json_loads(value):
+        # orjson reads integers beyond 64 bits as floats, keep them exact with the json module
+        if _LONG_DIGITS.search(value):
+            return json.loads(value)
+        return _orjson_loads(value)
+
+    def json_dumps(value):
+        try:
+            return _orjson_dumps(value).decode()
+        except JSONEncodeError:
+            # orjson only supports 64-bit integers, e.g. inside JSON values
+            return json.dumps(value)
+except ImportError:
+    from json import dumps as json_dumps, loads as json_loads
 
 logging.basicConfig(level=logging.DEBUG,
                     format='%(asctime)s - %(levelname)s - %(module)s - %(lineno)d - %(message)s',
                     datefmt='%Y-%m-%d %H:%M:%S')
 
+def is_rejected_request(exception):
+    # Client errors caused by the request itself, retrying them cannot succeed.
+    # Authentication errors are not included, they do not depend on the request body.
+    return (isinstance(exception, ApiException) and exception.status is not None
+            and 400 <= exception.status < 500 and exception.status not in (401, 403, 408, 429))
+
+def is_invalid_body(exception):
+    # Errors caused by some entries of the request body, e.g. an unparsable value or a too large payload
+    return isinstance(exception, ApiException) and exception.status in (400, 413)
+
+def is_retryable(exception):
+    if isinstance(exception, ApiException):
+        return not is_rejected_request(exception)
+    return isinstance(exception, (HTTPError, ConnectionError, TimeoutError))
+
+# ThingsBoard stores integer telemetry as 64-bit longs
+MIN_LONG, MAX_LONG = -2 ** 63, 2 ** 63 - 1
+
+retry_request = retry(stop=stop_after_attempt(5),
+                      wait=wait_exponential(multiplier=0.25, max=8) + wait_random(0, 0.5),
+                      retry=retry_if_exception(is_retryable),
+                      before_sleep=before_sleep_log(logging.getLogger(), logging.WARNING),
+                      reraise=True)
+
+def positive_int(value):
+    int_value = int(value)
+    if int_value < 1:
+        raise argparse.ArgumentTypeError(f"must be a positive integer, got {value}")
+    return int_value
+
 def parse_args():
     parser = argparse.ArgumentParser(description="Export and import time-series data from ThingsBoard")
     parser.add_argument("action", choices=["export", "import"], help="Action to perform")
     parser.add_argument("--host", required=True, help="ThingsBoard host URL")
     parser.add_argument("--username", required=True, help="Username for ThingsBoard")
     parser.add_argument("--password", required=True, help="Password for ThingsBoard")
-    parser.add_argument("--fileName", required=True, help="CSV file name")
+    parser.add_argument("--fileName", required=True, help="File name, compressed with gzip if it ends with .gz")
+    parser.add_argument("--format", choices=["csv", "ndjson"], default="csv", help="File format, ndjson stores one line per device and timestamp with native value types")
     parser.add_argument("--startTs", type=int, help="Start timestamp in milliseconds (for export)")
     parser.add_argument("--endTs", type=int, help="End timestamp in milliseconds (for export)")
     parser.add_argument("--deviceNames", help="Comma-separated list of device names (for export)")
     parser.add_argument("--keys", help="Comma-separated list of keys (optional, for export)", default=None)
     parser.add_argument("--chunkLimit", type=int, default=1024, help="Maximum number of records to fetch in each chunk")
     parser.add_argument("--timeLimit", type=int, default=60, help="Time range in minutes for each chunk")
+    parser.add_argument("--workers", type=positive_int, default=10, help="Number of concurrent requests to ThingsBoard")
+    parser.add_argument("--batchSize", type=positive_int, default=1000, help="Maximum number of timestamps to save in one request (for import)")
     return parser.parse_args()
 
+def open_file(file_name, mode):
+    if file_name.endswith('.gz'):
+        gzip_file = gzip.open(file_name, mode=mode + 'b', compresslevel=1)
+        if mode == 'w':
+            buffered_file = io.BufferedWriter(gzip_file, buffer_size=1 << 20)
+        else:
+            buffered_file = io.BufferedReader(gzip_file, buffer_size=1 << 20)
+        return io.TextIOWrapper(buffered_file, newline='')
+    return open(file_name, mode=mode, newline='', buffering=1 << 20)
+
 def get_all_keys(client, entity_type, entity_id):
     keys_response = client.get_timeseries_keys_v1(EntityId(entity_type=entity_type, id=entity_id))
     return ','.join(keys_response)
@@ -38,33 +110,66 @@ def get_device_id(client, device_name):
         logging.error(f"Error fetching device ID for {device_name}: {e}")
         return None
 
+def resolve_device_ids(executor, client, device_names):
+    device_ids = dict(zip(device_names, executor.map(lambda device_name: get_device_id(client, device_name), device_names)))
+    missing = [device_name for device_name, device_id in device_ids.items() if device_id is None]
+    if missing:
+        logging.warning(f"Skipping devices that could not be found: {', '.join(missing)}")
+    return {device_name: device_id for device_name, device_id in device_ids.items() if device_id is not None}
+
 def infer_type_and_convert(value):
     try:
-        if value.lower() == 'true':
-            return True, 'boolean'
-        elif value.lower() == 'false':
-            return False, 'boolean'
-        try:
-            int_value = int(value)
-            return int_value, 'int'
-        except ValueError:
-            pass
-        try:
-            float_value = float(value)
-            return float_value, 'double'
-        except ValueError:
-            pass
-        try:
-            json_value = json.loads(value.replace("'", '"'))
-            return json_value, 'json'
-        except json.JSONDecodeError:
-            pass
+        if isinstance(value, bool):
+            return value, 'boolean'
+        if isinstance(value, int):
+            return (value, 'int') if MIN_LONG <= value <= MAX_LONG else (str(value), 'string')
+        if isinstance(value, float):
+            return (value, 'double') if math.isfinite(value) else (str(value), 'string')
+        if isinstance(value, (dict, list)):
+            return json.dumps(value), 'json'
+        if not isinstance(value, str):
+            value = str(value)
+
+        first_char = value[:1]
+        if not first_char:
+            return value, 'string'
+        if first_char in '+-.0123456789':
+            if '.' not in value and 'e' not in value and 'E' not in value:
+                try:
+                    int_value = int(value)
+                    # Longer digit strings such as ICCIDs do not fit a long, keep them as strings
+                    if MIN_LONG <= int_value <= MAX_LONG:
+                        return int_value, 'int'
+                    return value, 'string'
+                except ValueError:
+                    pass
+            try:
+                float_value = float(value)
+                # Non-finite doubles (inf, nan, overflows like 1e999) are not valid JSON, keep them as strings
+                if math.isfinite(float_value):
+                    return float_value, 'double'
+            except ValueError:
+                pass
+        elif first_char in 'tTfF':
+            lower_value = value.lower()
+            if lower_value == 'true':
+                return True, 'boolean'
+            elif lower_value == 'false':
+                return False, 'boolean'
+        elif first_char in '{[':
+            # JSON values are only validated and kept serialized, so that they are exported as JSON text
+            for json_text in (value, value.replace("'", '"')):
+                try:
+                    json_loads(json_text)
+                    return json_text, 'json'
+                except json.JSONDecodeError:
+                    pass
         return value, 'string'
     except Exception as e:
         logging.warning(f"Could not infer type for value: {value}, error: {e}")
         return value, 'string'
 
-@retry(stop=stop_after_attempt(3), wait=wait_fixed(2))
+@retry_request
 def fetch_timeseries(client, entity_id, keys, start_ts, end_ts, chunk_limit):
     return client.get_timeseries(
         entity_id=entity_id, 
@@ -75,111 +180,203 @@ def fetch_timeseries(client, entity_id, keys, start_ts, end_ts, chunk_limit):
         order_by='ASC'
     )
 
-def export_timeseries(client, file_name, start_ts, end_ts, device_names, keys=None, chunk_limit=1024, time_limit=60):
-    time_limit_ms = time_limit * 60 * 1000
-    with open(file_name, mode='w', newline='') as file:
-        writer = csv.writer(file)
-        writer.writerow(['deviceId', 'key', 'ts', 'value', 'type'])
-
-        for device_name in device_names.split(','):
-            device_id = get_device_id(client, device_name)
-            logging.info(f"Processing telemetry export for device: {device_name} (ID: {device_id})")
-
-            if not keys:
-                keys = get_all_keys(client, 'DEVICE', device_id)
-            
-            current_start_ts = start_ts
-            while current_start_ts < end_ts:
-                current_end_ts = min(current_start_ts + time_limit_ms, end_ts)
-                try:
-                    timeseries_response = fetch_timeseries(client, EntityId(id=device_id, entity_type='DEVICE'), keys, current_start_ts, current_end_ts, chunk_limit)
+def fetch_timeseries_window(client, entity_id, keys, start_ts, end_ts, chunk_limit):
+    # Keys which returned chunk_limit data points are fetched again from their own last timestamp + 1,
+    # keys sharing the same last timestamp are fetched together
+    pending = {start_ts: keys.split(',')}
+    while pending:
+        page_start_ts, page_keys = pending.popitem()
+        timeseries_response = fetch_timeseries(client, entity_id, ','.join(page_keys), page_start_ts, end_ts, chunk_limit)
+        for key, data_points in timeseries_response.items():
+            if len(data_points) >= chunk_limit:
+                pending.setdefault(data_points[-1]['ts'] + 1, []).append(key)
+            yield key, data_points
 
-                    total_fetched = 0
-                    for key, data_points in timeseries_response.items():
-                        total_fetched += len(data_points)
-                        for data_point in data_points:
-                            ts = data_point.get('ts')
-                            raw_value = data_point.get('value')
-                            value, value_type = infer_type_and_convert(raw_value)
+def _export_device(client, file, format_lines, lock, device_name, device_id, start_ts, end_ts, keys, chunk_limit, time_limit_ms):
+    logging.info(f"Processing telemetry export for device: {device_name} (ID: {device_id})")
 
-                            writer.writerow([device_id, key, ts, value, value_type])
+    device_keys = keys if keys else get_all_keys(client, 'DEVICE', device_id)
 
-                    if total_fetched > 0:
-                        logging.info(f"Fetched {total_fetched} records for device with name {device_name} for period {current_start_ts} to {current_end_ts}")
-                except Exception as e:
-                    logging.error(f"Failed to fetch timeseries data for device {device_name} from {current_start_ts} to {current_end_ts}: {e}")
+    current_start_ts = start_ts
+    while current_start_ts < end_ts:
+        current_end_ts = min(current_start_ts + time_limit_ms, end_ts)
+        try:
+            timeseries_response = fetch_timeseries_window(client, EntityId(id=device_id, entity_type='DEVICE'), device_keys, current_start_ts, current_end_ts, chunk_limit)
 
-                current_start_ts = current_end_ts
+            batch = [(device_id, key, data_point['ts'], *infer_type_and_convert(data_point['value']))
+                     for key, data_points in timeseries_response for data_point in data_points]
+        except Exception as e:
+            logging.error(f"Failed to fetch timeseries data for device {device_name} from {current_start_ts} to {current_end_ts}: {e}")
+            batch = []
 
-            logging.info(f"Finished processing timeseries for device with name {device_name} for the period {start_ts} to {end_ts}")
+        if batch:
+            try:
+                lines = format_lines(batch)
+                with lock:
+                    file.writelines(lines)
+                logging.info(f"Fetched {len(batch)} records for device with name {device_name} for period {current_start_ts} to {current_end_ts}")
+            except Exception as e:
+                logging.error(f"Failed to write timeseries data for device {device_name} from {current_start_ts} to {current_end_ts}: {e}")
 
-@retry(stop=stop_after_attempt(3), wait=wait_fixed(2))
-def save_telemetry(client, entity_id, body):
-    client.save_entity_telemetry(entity_id=entity_id, scope='ANY', body=body)
+        current_start_ts = current_end_ts
 
-def import_timeseries(client, file_name, log_interval=100):
-    with open(file_name, mode='r') as file:
-        reader = csv.DictReader(file)
-        telemetry_data = {}
-        for row in reader:
-            device_id = row['deviceId']
-            key = row['key']
-            ts = int(row['ts'])
-            value = row['value']
-            value_type = row['type']
-
-            if device_id not in telemetry_data:
-                telemetry_data[device_id] = []
-
-            value_converted = value
-            if value_type == 'boolean':
-                value_converted = (value.lower() == 'true')
-            elif value_type == 'int':
-                value_converted = int(value)
-            elif value_type == 'double':
-                value_converted = float(value)
-            elif value_type == 'json':
-                try:
-                    value_converted = json.loads(value.replace("'", '"'))
-                except json.JSONDecodeError as e:
-                    logging.error(f"Failed to parse JSON value: {value}, error: {e}")
-                    continue
-
-            telemetry_data[device_id].append({"ts": ts, "values": {key: value_converted}})
-
-        for device_id, data_points in telemetry_data.items():
-            entity_id = EntityId(id=device_id, entity_type='DEVICE')
-            counter = 0
-            for data_point in data_points:
-                body = {
-                    "ts": data_point["ts"],
-                    "values": data_point["values"]
-                }
+    logging.info(f"Finished processing timeseries for device with name {device_name} for the period {start_ts} to {end_ts}")
+
+def _csv_lines(rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return [buffer.getvalue()]
+
+def _ndjson_lines(rows):
+    values_by_ts = defaultdict(dict)
+    for device_id, key, ts, value, value_type in rows:
+        values_by_ts[(device_id, ts)][key] = json_loads(value) if value_type == 'json' else value
+    return [json_dumps({'deviceId': device_id, 'ts': ts, 'values': values}) + '\n'
+            for (device_id, ts), values in sorted(values_by_ts.items())]
+
+def export_timeseries(client, file_name, start_ts, end_ts, device_names, keys=None, chunk_limit=1024, time_limit=60, workers=10, file_format='csv'):
+    time_limit_ms = time_limit * 60 * 1000
+    device_names = list(dict.fromkeys(device_names.split(',')))
+    lock = threading.Lock()
+    with open_file(file_name, 'w') as file:
+        if file_format == 'ndjson':
+            format_lines = _ndjson_lines
+        else:
+            csv.writer(file).writerow(['deviceId', 'key', 'ts', 'value', 'type'])
+            format_lines = _csv_lines
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            device_ids = resolve_device_ids(executor, client, device_names)
+            futures = {executor.submit(_export_device, client, file, format_lines, lock, device_name, device_id, start_ts, end_ts, keys, chunk_limit, time_limit_ms): device_name
+                       for device_name, device_id in device_ids.items()}
+            for future, device_name in futures.items():
                 try:
-                    save_telemetry(client, entity_id, body)
+                    future.result()
                 except Exception as e:
-                    logging.error(f"Failed to save telemetry for device {device_id}, data: {body}, error: {e}")
-                    continue
-                
-                counter += 1
-                if counter % log_interval == 0:
-                    logging.info(f"Saved {counter} telemetry entries for device {device_id}")
+                    logging.error(f"Failed to export timeseries data for device {device_name}: {e}")
+
+@retry_request
+def save_telemetry(client, entity_id, body):
+    client.save_entity_telemetry(entity_id=entity_id, scope='ANY', body=body)
+
+def _save_batch(client, device_id, batch):
+    try:
+        save_telemetry(client, EntityId(id=device_id, entity_type='DEVICE'), batch)
+    except Exception as e:
+        if len(batch) > 1 and is_invalid_body(e):
+            # Split the rejected batch in halves so that only the invalid entries are dropped
+            middle = len(batch) // 2
+            return _save_batch(client, device_id, batch[:middle]) + _save_batch(client, device_id, batch[middle:])
+        if len(batch) == 1:
+            logging.error(f"Failed to save telemetry for device {device_id}, data: {batch[0]}, error: {e}")
+        else:
+            logging.error(f"Failed to save {len(batch)} telemetry entries for device {device_id} starting at ts {batch[0]['ts']}, error: {e}")
+        return 0
+
+    logging.info(f"Saved {len(batch)} telemetry entries for device {device_id}")
+    return len(batch)
+
+def _parse_boolean(value):
+    return value.lower() == 'true'
+
+def _parse_json(value):
+    try:
+        return json_loads(value)
+    except json.JSONDecodeError:
+        # Files exported by earlier versions contain the Python repr of JSON values
+        return json_loads(value.replace("'", '"'))
+
+_CONVERTERS = {
+    'boolean': _parse_boolean,
+    'int': int,
+    'double': float,
+    'json': _parse_json,
+}
+
+def _convert_column(value_type, timestamps, values):
+    converter = _CONVERTERS.get(value_type)
+    if converter is None:
+        return zip(timestamps, values)
+
+    try:
+        return zip(timestamps, list(map(converter, values)))
+    except ValueError:
+        pass
+
+    # Fall back to converting value by value to skip only the invalid ones
+    converted = []
+    for ts, value in zip(timestamps, values):
+        try:
+            converted.append((ts, converter(value)))
+        except ValueError as e:
+            logging.error(f"Failed to parse {value_type} value: {value}, error: {e}")
+    return converted
+
+def _group_rows(rows):
+    columns = {}
+    for row in rows:
+        timestamps, values = columns.setdefault((row['deviceId'], row['key'], row['type']), ([], []))
+        timestamps.append(row['ts'])
+        values.append(row['value'])
+
+    telemetry_data = defaultdict(lambda: defaultdict(dict))
+    for (device_id, key, value_type), (timestamps, values) in columns.items():
+        values_by_ts = telemetry_data[device_id]
+        for ts, value_converted in _convert_column(value_type, list(map(int, timestamps)), values):
+            values_by_ts[ts][key] = value_converted
+    return telemetry_data
+
+def _group_records(lines):
+    telemetry_data = defaultdict(lambda: defaultdict(dict))
+    for line in lines:
+        if not line.strip():
+            continue
+        record = json_loads(line)
+        telemetry_data[record['deviceId']][record['ts']].update(record['values'])
+    return telemetry_data
+
+def _collect_saved(futures, counters):
+    for device_id, future in futures:
+        counters[device_id] += future.result()
+
+def import_timeseries(client, file_name, batch_size=1000, workers=10, chunk_size=50000, file_format='csv'):
+    counters = defaultdict(int)
+    with open_file(file_name, 'r') as file, ThreadPoolExecutor(max_workers=workers) as executor:
+        if file_format == 'ndjson':
+            reader, group = file, _group_records
+        else:
+            reader, group = csv.DictReader(file), _group_rows
+        futures = []
+        for rows in iter(lambda: list(islice(reader, chunk_size)), []):
+            telemetry_data = group(rows)
+            # Rows of the next chunk are parsed while the previous chunk is uploading,
+            # at most two chunks are kept in memory.
+            _collect_saved(futures, counters)
+            futures = []
+            for device_id, values_by_ts in telemetry_data.items():
+                entries = iter([{"ts": ts, "values": values} for ts, values in sorted(values_by_ts.items())])
+                futures.extend((device_id, executor.submit(_save_batch, client, device_id, batch))
+                               for batch in iter(lambda: list(islice(entries, batch_size)), []))
+        _collect_saved(futures, counters)
 
-            logging.info(f"Finished saving telemetry for device {device_id}, total entries: {counter}")
+    for device_id, counter in counters.items():
+        logging.info(f"Finished saving telemetry for device {device_id}, total entries: {counter}")
 
 def main():
     args = parse_args()
 
     with RestClientCE(base_url=args.host) as client:
+        # The connection pool is created on login, size it so every worker reuses its own kept-alive connection
+        client.configuration.connection_pool_maxsize = args.workers
         try:
             client.login(username=args.username, password=args.password)
             if args.action == 'export':
                 if not args.startTs or not args.endTs or not args.deviceNames:
                     logging.error("startTs, endTs, and deviceNames are required for export")
                     return
-                export_timeseries(client, args.fileName, args.startTs, args.endTs, args.deviceNames, args.keys, args.chunkLimit, args.timeLimit)
+                export_timeseries(client, args.fileName, args.startTs, args.endTs, args.deviceNames, args.keys, args.chunkLimit, args.timeLimit, args.workers, args.format)
             elif args.action == 'import':
-                import_timeseries(client, args.fileName)
+                import_timeseries(client, args.fileName, args.batchSize, args.workers, file_format=args.format)
         except ApiException as e:
             logging.exception(e)
 